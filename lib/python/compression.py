@@ -0,0 +1,255 @@
+# Name: compression.py
+# Purpose: Provides the output streams used by the tofasta.cgi script.  The FASTA
+#    response may be sent as plain text, as a gzip stream, or as BGZF (the blocked
+#    gzip format used by bgzip and samtools).  Each stream compresses incrementally,
+#    so every record can be flushed to the user as soon as it has been fetched.
+# Public Functions:
+#    acceptsGzip(acceptEncoding)
+# Public Classes:
+#    PlainWriter, GzipWriter, BgzfWriter, FaiIndexer, IndexWriter
+# Sample Usage:
+#    writer = GzipWriter(sys.stdout.buffer)
+#    writer.write('>seq1\nACGT\n')
+#    writer.flush()
+#    writer.close()
+
+import zlib
+import struct
+
+# default compression level for both gzip and BGZF output
+DEFAULT_LEVEL = 6
+
+# maximum number of uncompressed bytes in one BGZF block (matches bgzip and htslib)
+BGZF_BLOCK_SIZE = 0xff00
+
+# the empty BGZF block which marks the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+###--- functions ---###
+
+def acceptsGzip (acceptEncoding):
+    # Returns True if the given value of an HTTP Accept-Encoding header allows a
+    # gzip-encoded response, False if not.  A q-value given for gzip (or x-gzip)
+    # takes precedence over one given for '*' (RFC 9110, section 12.5.3).
+    gzipQ = None
+    anyQ = None
+    for item in (acceptEncoding or '').split(','):
+        fields = item.split(';')
+        coding = fields[0].strip().lower()
+        if coding not in ('gzip', 'x-gzip', '*'):
+            continue
+
+        q = 1.0
+        for param in fields[1:]:
+            name, sep, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+
+        if coding == '*':
+            anyQ = q
+        else:
+            gzipQ = max(q, gzipQ or 0.0)
+
+    if gzipQ is None:
+        gzipQ = anyQ
+    return (gzipQ is not None) and (gzipQ > 0)
+
+###--- classes ---###
+
+# Is an output stream for uncompressed FASTA text.  Other writers extend this one.
+class PlainWriter:
+    def __init__ (self, fd):
+        # 'fd' is the binary file object to which output is written (eg. sys.stdout.buffer)
+        self.fd = fd
+        return
+
+    def write (self, s):
+        # Writes string 's' to the stream.
+        self._write(s.encode('utf-8'))
+        return
+
+    def writeError (self, s):
+        # Writes error message 's' to the stream.
+        self.write(s)
+        return
+
+    def flush (self):
+        # Pushes everything written so far out to the user.
+        self.fd.flush()
+        return
+
+    def close (self):
+        # Finishes the stream; nothing may be written afterward.
+        self.flush()
+        return
+
+    def _write (self, data):
+        # Writes bytes 'data' to the stream.
+        self.fd.write(data)
+        return
+
+# Is an output stream that compresses its text as a single gzip member.  Each flush()
+# does a zlib sync flush, so the user can decompress everything written up to that point.
+class GzipWriter (PlainWriter):
+    def __init__ (self, fd, level = DEFAULT_LEVEL):
+        PlainWriter.__init__(self, fd)
+        # wbits of 16 + 15 has zlib write a gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return
+
+    def _write (self, data):
+        self.fd.write(self.compressor.compress(data))
+        return
+
+    def flush (self):
+        self.fd.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.fd.flush()
+        return
+
+    def close (self):
+        self.fd.write(self.compressor.flush(zlib.Z_FINISH))
+        self.fd.flush()
+        return
+
+# Is an output stream that compresses its text as BGZF:  a series of independent gzip
+# members of up to 64kb each, ending with an empty EOF block.  Each flush() closes off the
+# current block, so records start on block boundaries where possible.  The output can be
+# read by any gzip tool, and by bgzip/samtools/htslib for random access.
+class BgzfWriter (PlainWriter):
+    def __init__ (self, fd, level = DEFAULT_LEVEL):
+        PlainWriter.__init__(self, fd)
+        self.level = level
+        self.pending = bytearray()  # uncompressed bytes not yet written as a block
+        return
+
+    def _write (self, data):
+        # Fill and write whole blocks straight from 'data', keeping only the
+        # tail (shorter than one block) pending.
+        view = memoryview(data)
+        start = 0
+        if self.pending:
+            start = min(len(view), BGZF_BLOCK_SIZE - len(self.pending))
+            self.pending.extend(view[:start])
+            if len(self.pending) < BGZF_BLOCK_SIZE:
+                return
+            self._writeBlock(bytes(self.pending))
+            del self.pending[:]
+
+        while len(view) - start >= BGZF_BLOCK_SIZE:
+            self._writeBlock(view[start:start + BGZF_BLOCK_SIZE])
+            start = start + BGZF_BLOCK_SIZE
+        self.pending.extend(view[start:])
+        return
+
+    def _writeBlock (self, data):
+        # Compresses bytes 'data' (no more than BGZF_BLOCK_SIZE of them) and writes them
+        # as one BGZF block.
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+
+        # 18-byte gzip header, with the 'BC' extra subfield giving the block size - 1
+        bsize = 18 + len(cdata) + 8 - 1
+        header = struct.pack('<4BIBBHBBHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+            ord('B'), ord('C'), 2, bsize)
+        trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+        self.fd.write(header + cdata + trailer)
+        return
+
+    def flush (self):
+        if self.pending:
+            self._writeBlock(bytes(self.pending))
+            del self.pending[:]
+        self.fd.flush()
+        return
+
+    def close (self):
+        self.flush()
+        self.fd.write(BGZF_EOF)
+        self.fd.flush()
+        return
+
+# Builds a samtools-compatible .fai index for FASTA text as it goes by.  Offsets refer to
+# the uncompressed text, so the index applies both to a plain FASTA and to a BGZF download
+# of the same text.  (For BGZF, samtools also wants a .gzi file, which can be rebuilt from
+# the download with 'bgzip -r'.)
+class FaiIndexer:
+    def __init__ (self):
+        self.offset = 0         # byte offset of the start of the next complete line
+        self.partial = ''       # trailing text not yet ended by a newline
+        self.entries = []       # [ name, length, offset, line bases, line width ] per record
+        return
+
+    def update (self, s):
+        # Adds FASTA text 's' to the index.
+        lines = (self.partial + s).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._addLine(line)
+        return
+
+    def _addLine (self, line):
+        width = len(line.encode('utf-8')) + 1
+        if line.startswith('>'):
+            words = line[1:].split()
+            name = ''
+            if words:
+                name = words[0]
+            self.entries.append([name, 0, self.offset + width, 0, 0])
+
+        elif self.entries and line.strip():
+            entry = self.entries[-1]
+            bases = len(line.rstrip('\r'))
+            if entry[3] == 0:
+                entry[3] = bases
+                entry[4] = width
+            entry[1] = entry[1] + bases
+
+        self.offset = self.offset + width
+        return
+
+    def getIndex (self):
+        # Returns the contents of the .fai file, as a string.
+        if self.partial:
+            self._addLine(self.partial)
+            self.partial = ''
+        return ''.join(['%s\t%d\t%d\t%d\t%d\n' % tuple(e) for e in self.entries])
+
+# Is an output stream which writes none of the FASTA text it is given, but instead writes
+# its HTTP headers and .fai index when closed.  If any error message was written, there is
+# no index at all (a partial one would silently give wrong offsets for every record after
+# a missing one); the response is instead an error status with the messages.
+class IndexWriter (PlainWriter):
+    def __init__ (self, fd, headers):
+        # 'headers' is the list of HTTP header lines to send along with the index
+        PlainWriter.__init__(self, fd)
+        self.headers = headers
+        self.indexer = FaiIndexer()
+        self.errors = []
+        return
+
+    def write (self, s):
+        self.indexer.update(s)
+        return
+
+    def writeError (self, s):
+        self.errors.append(s)
+        return
+
+    def flush (self):
+        return
+
+    def close (self):
+        if self.errors:
+            headers = [ 'Status: 500 Internal Server Error', 'Content-type: text/plain' ]
+            body = 'No index was made, as not every sequence could be retrieved.\n' + \
+                ''.join(self.errors)
+        else:
+            headers = self.headers
+            body = self.indexer.getIndex()
+
+        self.fd.write(('\n'.join(headers) + '\n\n' + body).encode('utf-8'))
+        self.fd.flush()
+        return
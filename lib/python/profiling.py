@@ -0,0 +1,131 @@
+# Name: profiling.py
+# Purpose: Provides per-request profiling for the tofasta.cgi script.  A profiled
+#    request is run under cProfile, or under a wall-clock sampler (a background thread)
+#    which records its Python call stacks, or both.  Time spent sleeping (Entrez rate
+#    limiting) or waiting on the network shows up alongside time spent computing.
+#    Depending on the mode, each request writes one or both of:
+#        <name>.pstats - cProfile statistics, readable with the pstats module
+#        <name>.folded - collapsed stacks ("a;b;c count" per line), as read by
+#                        flamegraph.pl, speedscope, and similar tools; each frame
+#                        is file:function, plus :line for the innermost one
+#    From Python 3.12, cProfile records every thread, so it would mix the sampler's
+#    calls in with the request's.  There, mode 'both' only runs the sampler.
+# Public Functions:
+#    None
+# Public Classes:
+#    RequestProfiler
+# Sample Usage:
+#    profiler = RequestProfiler('/usr/local/mgi/live/seqfetch/logs/profiles')
+#    result = profiler.run(myFunction, arg1, arg2)
+#    profiler.save()
+
+import cProfile
+import os
+import sys
+import threading
+import time
+
+# default number of seconds between stack samples
+DEFAULT_INTERVAL = 0.005
+
+# profiling modes:  cProfile only, stack sampler only, or both
+MODES = [ 'pstats', 'folded', 'both' ]
+
+# can cProfile run alongside the sampler thread without recording it?
+PER_THREAD_CPROFILE = sys.version_info < (3, 12)
+
+###--- classes ---###
+
+# Is a profiler for a single request.
+class RequestProfiler:
+    def __init__ (self, directory, interval = DEFAULT_INTERVAL, mode = 'both'):
+        # 'directory' is where the profile files are written; 'interval' is the number of
+        # seconds between stack samples; 'mode' is one of MODES.
+        self.directory = directory
+        self.interval = interval
+
+        self.profile = None
+        if mode in ('pstats', 'both'):
+            if (mode == 'pstats') or PER_THREAD_CPROFILE:
+                self.profile = cProfile.Profile()
+        self.sampling = mode in ('folded', 'both')
+
+        self.stacks = {}            # collapsed stack -> number of samples
+        self.filenames = {}         # co_filename -> its basename, for the samples
+        self.threadId = None        # thread being profiled
+        self.sampler = None         # thread taking the samples
+        self.stopping = threading.Event()
+        self.name = 'seqfetch.%s.%d' % (time.strftime('%Y%m%d.%H%M%S'), os.getpid())
+        return
+
+    def run (self, function, *args):
+        # Calls 'function' with the given 'args' while profiling, and returns its result.
+        self._start()
+        try:
+            return function(*args)
+        finally:
+            self._stop()
+
+    def save (self):
+        # Writes the .pstats and/or .folded files for this request.
+        # Returns the path to the files, without their extensions.
+        base = os.path.join(self.directory, self.name)
+        if self.profile:
+            self.profile.dump_stats(base + '.pstats')
+
+        if self.sampling:
+            fd = open(base + '.folded', 'w')
+            for stack in sorted(self.stacks.keys()):
+                fd.write('%s %d\n' % (stack, self.stacks[stack]))
+            fd.close()
+        return base
+
+    def _start (self):
+        if self.sampling:
+            self.threadId = threading.get_ident()
+            self.sampler = threading.Thread(target = self._sampleLoop)
+            self.sampler.daemon = True
+            self.sampler.start()
+        if self.profile:
+            self.profile.enable()
+        return
+
+    def _stop (self):
+        if self.profile:
+            self.profile.disable()
+        if self.sampling:
+            self.stopping.set()
+            self.sampler.join()
+        return
+
+    def _sampleLoop (self):
+        # Runs in the sampler thread; samples the profiled thread's stack every
+        # 'interval' seconds until _stop() is called.
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            if frame is not None:
+                self._sample(frame)
+        return
+
+    def _sample (self, frame):
+        # Records the stack ending at 'frame', outermost first.  The innermost frame
+        # also gets its line number, since time in a C call (eg. time.sleep or a socket
+        # read) is charged to the Python line that made it.
+        stack = []
+        leaf = frame
+        while frame is not None:
+            code = frame.f_code
+            filename = self.filenames.get(code.co_filename)
+            if filename is None:
+                filename = os.path.basename(code.co_filename)
+                self.filenames[code.co_filename] = filename
+            if frame is leaf:
+                stack.append('%s:%s:%d' % (filename, code.co_name, frame.f_lineno))
+            else:
+                stack.append('%s:%s' % (filename, code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+
+        key = ';'.join(stack)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        return
@@ -34,6 +34,7 @@ import os
 import time
 import re
 import sys
+import random
 import log
 
 from types import *
@@ -42,7 +43,10 @@ from types import *
 
 # Sequence Retrieval Tool library
 
+import errorlib
 import CGInocontenttype
+import compression
+import profiling
 
 import fetcher
 if config.has_key('GENOME_BUILD'):
@@ -56,6 +60,41 @@ maxSeqs = 1000
 if config.has_key('MAX_SEQS'):
     maxSeqs = int(config.get('MAX_SEQS'))
 
+# gzip-encode plain FASTA responses for clients that accept it? (0/1)
+compressResponses = '0'
+if config.has_key('COMPRESS_RESPONSES'):
+    compressResponses = config.get('COMPRESS_RESPONSES')
+
+compressionLevel = compression.DEFAULT_LEVEL
+if config.has_key('COMPRESSION_LEVEL'):
+    compressionLevel = int(config.get('COMPRESSION_LEVEL'))
+
+# values allowed for the 'format' parameter
+FORMATS = [ 'fasta', 'gzip', 'bgzf', 'fai' ]
+
+# fraction of requests (0.0 - 1.0) to profile, and where to write profiles
+profileRate = 0.0
+if config.has_key('PROFILE_RATE'):
+    profileRate = float(config.get('PROFILE_RATE'))
+
+profileDir = '/tmp'
+if config.has_key('PROFILE_DIR'):
+    profileDir = config.get('PROFILE_DIR')
+
+profileInterval = profiling.DEFAULT_INTERVAL
+if config.has_key('PROFILE_INTERVAL'):
+    profileInterval = float(config.get('PROFILE_INTERVAL'))
+
+# which profiles to write (one of profiling.MODES)
+profileMode = 'both'
+if config.has_key('PROFILE_MODE'):
+    profileMode = config.get('PROFILE_MODE')
+
+# a request with a 'profile' parameter matching this key is always profiled
+profileKey = ''
+if config.has_key('PROFILE_KEY'):
+    profileKey = config.get('PROFILE_KEY')
+
 ###########################################
 # exception values when 'error' is raised #
 ###########################################
@@ -77,6 +116,137 @@ class ToFASTACGI (CGInocontenttype.CGI):
     # DOES: fetches the sequence from the remote web site and returns
     #       results to the user.
 
+    def go (self,
+        handler = errorlib.handle_error # function to call if an
+                                        # exception occurs
+        ):
+        # Purpose: wraps the main() method in exception handling, as
+        #    in CGInocontenttype.CGI, but makes sure the HTTP headers
+        #    go out before the error handler writes anything.
+        # Returns: nothing
+        # Assumes: nothing
+        # Effects: see main()
+        # Throws: nothing
+
+        self.output = None
+        self.errorHandler = handler
+        CGInocontenttype.CGI.go(self, self.handleError)
+        return
+
+    def handleError (self):
+        # Purpose: called by go() for an exception from main().  If a
+        #    compressed (or index) stream is open, the error goes into
+        #    it and the stream is closed, as the error handler's text
+        #    would corrupt it.  Otherwise we write a text/plain header
+        #    if startOutput() has not yet run, and pass the exception
+        #    along to the error handler.
+        # Returns: nothing
+        # Assumes: we are called from within an 'except' clause
+        # Effects: writes to stdout and stderr
+        # Throws: nothing
+
+        if (self.output is not None) and \
+                (type(self.output) != compression.PlainWriter):
+            message = sys.exc_info()[1]
+            sys.stderr.write('seqfetch error: %s\n' % message)
+            # either step may fail again if the user has gone (eg. a
+            # broken pipe), in which case there is nobody left to tell
+            try:
+                self.output.writeError('*****\n' + \
+                    'An error occurred while trying to retrieve your ' + \
+                    'sequence(s).\n-----\n%s\n*****\n' % message)
+            except Exception:
+                pass
+            try:
+                self.output.close()
+            except Exception:
+                pass
+            return
+
+        if self.output is None:
+            print('Content-type: text/plain\n')
+            sys.stdout.flush()
+        self.errorHandler()
+        return
+
+    def startOutput (self,
+        format        # string; requested output format (one of FORMATS)
+        ):
+        # Purpose: writes the HTTP headers for the given output 'format'
+        #    and returns the stream to which the response body should
+        #    be written.
+        # Returns: compression.PlainWriter (or a subclass of it)
+        # Assumes: nothing has yet been written to stdout.
+        # Effects: writes to stdout
+        # Throws: nothing
+        # Notes: Plain FASTA is gzip-encoded in transit if the
+        #    COMPRESS_RESPONSES option is on and the client's
+        #    Accept-Encoding allows it.  An unknown 'format' gets plain
+        #    text, so its error message can be read.  For 'fai', the
+        #    headers are left to the IndexWriter.
+
+        fd = sys.stdout.buffer
+        headers = []
+
+        if format == 'gzip':
+            headers.append('Content-type: application/gzip')
+            headers.append('Content-Disposition: attachment; filename="seqfetch.fa.gz"')
+            writer = compression.GzipWriter(fd, compressionLevel)
+
+        elif format == 'bgzf':
+            headers.append('Content-type: application/gzip')
+            headers.append('Content-Disposition: attachment; filename="seqfetch.fa.gz"')
+            writer = compression.BgzfWriter(fd, compressionLevel)
+
+        elif format == 'fai':
+            # the IndexWriter sends these itself, once it knows that
+            # every sequence was retrieved
+            writer = compression.IndexWriter(fd, [
+                'Content-type: text/plain',
+                'Content-Disposition: attachment; filename="seqfetch.fa.gz.fai"',
+                ])
+            self.output = writer
+            return writer
+
+        else:
+            headers.append('Content-type: text/plain')
+            if (compressResponses != '0') and compression.acceptsGzip(
+                    os.environ.get('HTTP_ACCEPT_ENCODING', '')):
+                headers.append('Content-Encoding: gzip')
+                headers.append('Vary: Accept-Encoding')
+                writer = compression.GzipWriter(fd, compressionLevel)
+            else:
+                writer = compression.PlainWriter(fd)
+
+        for header in headers:
+            print(header)
+        print('')
+        sys.stdout.flush()
+        self.output = writer
+        return writer
+
+    def getProfiler (self,
+        parms        # dictionary of parameters, as from get_parms()
+        ):
+        # Purpose: decides whether this request should be profiled
+        # Returns: profiling.RequestProfiler, or None if this request
+        #    is not to be profiled
+        # Assumes: nothing
+        # Effects: nothing
+        # Throws: nothing
+        # Notes: A request is profiled if its 'profile' parameter
+        #    matches the PROFILE_KEY option, or else at random for
+        #    PROFILE_RATE of all requests.
+
+        requested = False
+        if profileKey and ('profile' in parms):
+            requested = (parms['profile'] == profileKey)
+
+        if requested or (random.random() < profileRate):
+            return profiling.RequestProfiler(profileDir, profileInterval,
+                profileMode)
+        return None
+
     def main (self):
         # Purpose: This serves as the (conceptual) main program for
         #    the ToFASTA CGI script.
@@ -95,25 +265,48 @@ class ToFASTACGI (CGInocontenttype.CGI):
 
         parms = self.get_parms()
         
-        log.write('Got parameters:')
+        # the privileged 'profile' key is neither logged nor echoed back
+        shownParms = {}
         for k in parms.keys():
-            log.write('- %s: %s' % (k, str(parms[k])))
+            if k != 'profile':
+                shownParms[k] = parms[k]
+
+        log.write('Got parameters:')
+        for k in shownParms.keys():
+            log.write('- %s: %s' % (k, str(shownParms[k])))
+
+        format = 'fasta'
+        if ('format' in parms) and (type(parms['format']) == str):
+            format = parms['format'].strip().lower()
+
+        output = self.startOutput(format)
+        profiler = self.getProfiler(parms)
 
         if debug != '0':
-            print("Input Parms")
-            print(parms)
-            print(" ")
+            output.write("Input Parms\n")
+            output.write("%s\n" % str(shownParms))
+            output.write(" \n")
 
         try:
             # The call to parseParameters() may raise the 'error'
             # exception.  We catch it below and display its
             # accompanying message for the user.
 
-            sequence,debug = parseParameters (parms)
+            if format not in FORMATS:
+                raise Exception('Unknown format "%s"; please use one of: %s' \
+                    % (format, ', '.join(FORMATS)))
+
+            # sequences are written to 'output' as they are fetched
+            # (the profiler covers parseParameters and each of its
+            # calls to fetcher.fetch)
+            if profiler:
+                sequence,debug = profiler.run (parseParameters,
+                    parms, output)
+            else:
+                sequence,debug = parseParameters (parms, output)
             log.write('Got sequence')
 
-            # send the output to the user
-            output = [sequence]
+            lines = []
                 
         except Exception as message:
             # Give an error screen to the user which passes
@@ -129,29 +322,39 @@ class ToFASTACGI (CGInocontenttype.CGI):
                 '*****'
                 ]
 
-            output = list
+            lines = list
             log.write('Caught exception')
 
             sys.stderr.write('seqfetch error: %s\n' % message)
 
-        for line in output:
-            print(line)
+        for line in lines:
+            output.writeError(line + '\n')
+        output.close()
         log.write('Wrote output to user')
+
+        if profiler:
+            try:
+                log.write('Wrote profile %s' % profiler.save())
+            except Exception as message:
+                sys.stderr.write('seqfetch profile error: %s\n' % message)
         return
 
 ###--- Private Functions ---###
 
 def parseParameters (
-    parms        # Dictionary of parameters received from an HTML form,
+    parms,        # Dictionary of parameters received from an HTML form,
                   # as returned by CGI.get_parms().
+    output = None # compression.PlainWriter to which each sequence is
+                  # written as it is fetched; if None, sequences are
+                  # collected and returned instead
     ):
     # Purpose: parse the given set of 'parms' to get and return a tuple
     #    of ten items.  performs error checking to ensure complete and
     #    consistent input.
-    # Returns: 1. sequence
+    # Returns: 1. sequence (empty if 'output' was given)
     #          2. debug variable
     # Assumes: nothing
-    # Effects: nothing
+    # Effects: writes to 'output' (or stdout, if no 'output' is given)
     # Throws: 'error' if any problems with the parameters are found
     
     # set a default for each parameter expected (each described above)
@@ -210,15 +413,26 @@ sequence, and then download in FASTA format.''')
 
             for seqitem in inputSeqList:
                 try:
-                    outputSequences.append(fetcher.fetch(seqitem).replace('\n\n', '\n'))
+                    seq = fetcher.fetch(seqitem).replace('\n\n', '\n')
                 except Exception as message:
                     errors.append('Error retrieving %s : %s' % (seqitem, message))
+                    continue
+
+                if output:
+                    output.write(seq)
+                    output.flush()
+                else:
+                    outputSequences.append(seq)
 
-    # error reporting
+    # error reporting (when streaming, this follows the sequences)
     if errors:
-        print("*****\n" + \
+        errorBlock = "*****\n" + \
               "An error occurred while trying to retrieve your " + \
-              "sequence(s).\n-----\n%s\n*****" % '\n'.join(errors))
+              "sequence(s).\n-----\n%s\n*****" % '\n'.join(errors)
+        if output:
+            output.writeError(errorBlock + '\n')
+        else:
+            print(errorBlock)
         
     return ''.join(outputSequences),debug
 
@@ -19,9 +19,17 @@
 #                    2) seqID
 #                    3) begin coordinate (optional)
 #                    4) end coordinate (optional)
-#   Outputs: 1) plain text file of sequences in FASTA format.
+#            3) format (optional):  fasta (default), gzip, bgzf, or fai
+#   Outputs: 1) plain text file of sequences in FASTA format, or a gzip or
+#               BGZF compressed copy of it, or its .fai index.
+#               The .fai comes from a separate request, which fetches every
+#               sequence again.  It only matches a FASTA or BGZF download of
+#               the same sequences that had no errors (no '*****' block), and
+#               only if no sequence changed in between.  If any sequence
+#               fails in the fai request itself, no index is returned, only
+#               an error status and the messages.
 #            2) errors specifying when sequences not found in GCG
-#               that appear at top of output flanked by '*****'.
+#               that appear at end of output flanked by '*****'.
 #   Exit Codes: none
 #   Assumes: 1) Configuration file exists.
 #   Other System Requirements:
@@ -71,7 +79,8 @@ log.write('Loaded tofasta library')
 # main    #
 ###########
 
-print('Content-type: text/plain\n')
+# HTTP headers are written by ToFASTACGI, as they depend on the requested
+# output format and on the client's Accept-Encoding.
 
 if __name__ == '__main__':
     log.write('Starting')